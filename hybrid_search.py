@@ -1,8 +1,12 @@
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import streamlit as st
 from langchain_couchbase.vectorstores import CouchbaseVectorStore
+import inspect
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from langchain_openai import OpenAIEmbeddings
+from langchain_core.embeddings import Embeddings
 from couchbase.cluster import Cluster
 from couchbase.auth import PasswordAuthenticator
 from couchbase.options import ClusterOptions
@@ -11,6 +15,39 @@ import couchbase.search as search
 from couchbase.options import SearchOptions
 from couchbase.vector_search import VectorQuery, VectorSearch
 from openai import OpenAI
+import httpx
+
+# Matches the resizing and cropping parameters in the IMDB poster URLs
+POSTER_RESIZE_PATTERN = re.compile(r"_V1_.*?_AL_")
+
+# Vector query prefilters are only supported by newer versions of the SDK
+SUPPORTS_PREFILTER = "prefilter" in inspect.signature(VectorQuery).parameters
+
+# Number of candidates fetched per result when the filters can't be prefiltered
+OVERSAMPLING_FACTOR = 5
+
+# Fields displayed for each result, all of which are stored in the search index
+RESULT_FIELDS = [
+    "Series_Title",
+    "Poster_Link",
+    "Overview",
+    "Released_Year",
+    "IMDB_Rating",
+    "Runtime",
+]
+
+
+class LocalEmbeddings(Embeddings):
+    """LangChain embeddings generated locally by a fastembed model"""
+
+    def __init__(self, model: Any):
+        self.model = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [embedding.tolist() for embedding in self.model.embed(texts)]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
 
 
 def check_environment_variable(variable_name):
@@ -22,19 +59,66 @@ def check_environment_variable(variable_name):
         st.stop()
 
 
-def generate_embeddings(client, input_data):
+@st.cache_data(ttl=300, max_entries=1024, show_spinner=False)
+def generate_embeddings(_client, embedding_model, input_data):
     """Generate OpenAI embeddings for the input data"""
-    response = client.embeddings.create(input=input_data, model=EMBEDDING_MODEL)
+    response = _client.embeddings.create(input=input_data, model=embedding_model)
     return response.data[0].embedding
 
 
+@st.cache_data(ttl=300, max_entries=1024, show_spinner=False)
+def generate_local_embeddings(_model, embedding_model, input_data):
+    """Generate embeddings for the input data locally using fastembed"""
+    return next(iter(_model.embed([input_data]))).tolist()
+
+
+@st.cache_data(ttl=300, max_entries=1024, show_spinner=False)
+def embed_query(_embedding, embedding_model, query):
+    """Generate the LangChain embeddings for the search query"""
+    return _embedding.embed_query(query)
+
+
 def cleanup_poster_url(poster_url):
     """Convert from https://m.media-amazon.com/images/M/MV5BMDFkYTc0MGEtZmNhMC00ZDIzLWFmNTEtODM1ZmRlYWMwMWFmXkEyXkFqcGdeQXVyMTMxODk2OTU@._V1_UX67_CR0,0,67,98_AL_.jpg to https://m.media-amazon.com/images/M/MV5BMDFkYTc0MGEtZmNhMC00ZDIzLWFmNTEtODM1ZmRlYWMwMWFmXkEyXkFqcGdeQXVyMTMxODk2OTU@._V1_.jpg"""
 
-    prefix = poster_url.split("_V1_")[0]
-    suffix = poster_url.split("_AL_")[1]
+    return POSTER_RESIZE_PATTERN.sub("_V1_", poster_url)
+
 
-    return prefix + suffix
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    """Return the HTTP/2 client shared by the OpenAI clients"""
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+        timeout=30.0,
+    )
+
+
+@st.cache_resource
+def get_openai_client() -> OpenAI:
+    """Return the native OpenAI client shared across reruns"""
+    return OpenAI(http_client=get_http_client())
+
+
+@st.cache_resource
+def get_openai_embeddings(embedding_model: str) -> OpenAIEmbeddings:
+    """Return the LangChain OpenAI embeddings shared across reruns"""
+    return OpenAIEmbeddings(model=embedding_model, http_client=get_http_client())
+
+
+@st.cache_resource(show_spinner="Loading the embedding model")
+def get_local_embedding_model(embedding_model: str) -> Any:
+    """Return the local fastembed model shared across reruns"""
+    # Imported here so that the OpenAI provider doesn't load fastembed
+    from fastembed import TextEmbedding
+
+    return TextEmbedding(model_name=embedding_model)
+
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Return the thread pool used to run the batch searches concurrently"""
+    return ThreadPoolExecutor(max_workers=4)
 
 
 @st.cache_resource(show_spinner="Connecting to Couchbase")
@@ -77,7 +161,6 @@ def get_couchbase_vector_store(
     return vector_store
 
 
-@st.cache_resource
 def create_filter(
     year_range: Tuple[int], rating: float, search_in_title: bool, title: str
 ) -> Dict[str, Any]:
@@ -117,6 +200,13 @@ def create_filter(
     return filter
 
 
+def generate_query_embedding(embedding_client: Any, search_text: str) -> List[float]:
+    """Generate the embeddings for the search text using the configured provider"""
+    if EMBEDDING_PROVIDER == "fastembed":
+        return generate_local_embeddings(embedding_client, EMBEDDING_MODEL, search_text)
+    return generate_embeddings(embedding_client, EMBEDDING_MODEL, search_text)
+
+
 def search_couchbase(
     db_scope: Any,
     index_name: str,
@@ -124,46 +214,127 @@ def search_couchbase(
     embedding_key: str,
     search_text: str,
     k: int = 5,
-    fields: List[str] = ["*"],
+    fields: List[str] = RESULT_FIELDS,
     search_options: Dict[str, Any] = {},
+    search_embedding: Optional[List[float]] = None,
+    prefilter: bool = False,
 ):
     """Hybrid search using Python SDK in couchbase"""
-    # Generate vector embeddings to search with
-    search_embedding = generate_embeddings(embedding_client, search_text)
+    # Generate vector embeddings to search with unless already generated
+    if search_embedding is None:
+        search_embedding = generate_query_embedding(embedding_client, search_text)
+
+    yield from vector_search(
+        db_scope,
+        index_name,
+        embedding_key,
+        search_embedding,
+        k,
+        fields,
+        search_options,
+        prefilter,
+    )
 
-    # Create the search request
-    search_req = search.SearchRequest.create(
-        VectorSearch.from_vector_query(
-            VectorQuery(
+
+def search_couchbase_batch(
+    db_scope: Any,
+    index_name: str,
+    embedding_client: Any,
+    embedding_model: str,
+    embedding_key: str,
+    search_texts: List[str],
+    k: int = 5,
+    fields: List[str] = RESULT_FIELDS,
+    search_options: Dict[str, Any] = {},
+    prefilter: bool = False,
+    embedding_provider: str = "openai",
+) -> List[List[Tuple[Dict[str, Any], float]]]:
+    """Hybrid search for multiple texts sharing the same filters using Python SDK in couchbase"""
+    if not search_texts:
+        return []
+
+    # Generate vector embeddings for all the texts in a single batch
+    if embedding_provider == "fastembed":
+        search_embeddings = [
+            embedding.tolist() for embedding in embedding_client.embed(search_texts)
+        ]
+    else:
+        response = embedding_client.embeddings.create(
+            input=search_texts, model=embedding_model
+        )
+        search_embeddings = [d.embedding for d in response.data]
+
+    # The results of multiple vector queries in a single request are merged,
+    # so each text is searched in its own request and these are run concurrently
+    futures = [
+        get_executor().submit(
+            list,
+            vector_search(
+                db_scope,
+                index_name,
                 embedding_key,
                 search_embedding,
                 k,
-            )
+                fields,
+                search_options,
+                prefilter,
+            ),
         )
-    )
+        for search_embedding in search_embeddings
+    ]
+    return [future.result() for future in futures]
 
-    docs_with_score = []
-
-    try:
-        # Perform the search
-        search_iter = db_scope.search(
-            index_name,
-            search_req,
-            SearchOptions(
-                limit=k,
-                fields=fields,
-                raw=search_options,
-            ),
+
+def vector_search(
+    db_scope: Any,
+    index_name: str,
+    embedding_key: str,
+    search_embedding: List[float],
+    k: int,
+    fields: List[str],
+    search_options: Dict[str, Any],
+    prefilter: bool = False,
+):
+    """Search the index with the embedding and yield the results as they are returned"""
+    num_candidates = k
+    prefilter_query = None
+    filter_query = search_options.get("query", {})
+    if prefilter and filter_query.get("conjuncts"):
+        if SUPPORTS_PREFILTER:
+            # Apply the filters before the nearest neighbours are selected
+            prefilter_query = search.RawQuery(filter_query)
+            search_options = {
+                key: value for key, value in search_options.items() if key != "query"
+            }
+        else:
+            # Fetch more candidates so that k results remain after filtering
+            num_candidates = k * OVERSAMPLING_FACTOR
+
+    # Create the search request
+    if prefilter_query is not None:
+        vector_query = VectorQuery(
+            embedding_key, search_embedding, num_candidates, prefilter=prefilter_query
         )
+    else:
+        vector_query = VectorQuery(embedding_key, search_embedding, num_candidates)
+    search_req = search.SearchRequest.create(
+        VectorSearch.from_vector_query(vector_query)
+    )
 
-        # Parse the results
-        for row in search_iter.rows():
-            score = row.score
-            docs_with_score.append((row.fields, score))
-    except Exception as e:
-        raise e
+    # Perform the search
+    search_iter = db_scope.search(
+        index_name,
+        search_req,
+        SearchOptions(
+            limit=k,
+            fields=fields,
+            raw=search_options,
+        ),
+    )
 
-    return docs_with_score
+    # Yield the results as they are returned
+    for row in search_iter.rows():
+        yield row.fields, row.score
 
 
 if __name__ == "__main__":
@@ -184,13 +355,18 @@ if __name__ == "__main__":
     DB_COLLECTION = os.getenv("DB_COLLECTION")
     INDEX_NAME = os.getenv("INDEX_NAME")
     EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+    EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
 
-    # Use text-embedding-3-small as the embedding model if not set
+    # Use the default embedding model for the provider if not set
     if not EMBEDDING_MODEL:
-        EMBEDDING_MODEL = "text-embedding-3-small"
+        if EMBEDDING_PROVIDER == "fastembed":
+            EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+        else:
+            EMBEDDING_MODEL = "text-embedding-3-small"
 
     # Ensure that all environment variables are set
-    check_environment_variable("OPENAI_API_KEY")
+    if EMBEDDING_PROVIDER != "fastembed":
+        check_environment_variable("OPENAI_API_KEY")
     check_environment_variable("DB_CONN_STR")
     check_environment_variable("DB_USERNAME")
     check_environment_variable("DB_PASSWORD")
@@ -201,12 +377,20 @@ if __name__ == "__main__":
 
     # Initialize empty filters
     search_filters = {}
+    prefilter = False
 
-    # Native OpenAI library for generating embeddings
-    openai_embedding_client = OpenAI()
+    if EMBEDDING_PROVIDER == "fastembed":
+        # Local fastembed model for generating embeddings without network calls
+        embedding_client = get_local_embedding_model(EMBEDDING_MODEL)
 
-    # Use OpenAI Embeddings from LangChain
-    embedding = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+        # Use the same local model for the LangChain embeddings
+        embedding = LocalEmbeddings(embedding_client)
+    else:
+        # Native OpenAI library for generating embeddings
+        embedding_client = get_openai_client()
+
+        # Use OpenAI Embeddings from LangChain
+        embedding = get_openai_embeddings(EMBEDDING_MODEL)
 
     # Connect to Couchbase Vector Store
     cluster = connect_to_couchbase(DB_CONN_STR, DB_USERNAME, DB_PASSWORD)
@@ -241,25 +425,35 @@ if __name__ == "__main__":
             year_range = st.slider("Released Year", 1900, 2024, (1900, 2024))
             rating = st.number_input("Minimum IMDB Rating", 0.0, 10.0, 0.0, step=1.0)
             search_in_title = st.checkbox("Search in Title?")
+            prefilter = st.checkbox(
+                "Prefilter vector search",
+                help="Apply the filters before the vector search. "
+                "Requires Couchbase Server 7.6.4 or higher. "
+                "Only used when searching with the Couchbase Python SDK.",
+            )
             show_filter = st.checkbox("Show filter")
             hybrid_search_filter = create_filter(
                 year_range, rating, search_in_title, text
             )
+            search_filters = hybrid_search_filter
             if show_filter:
                 st.json(hybrid_search_filter)
 
     submit = st.button("Submit")
 
     if submit:
-        # Fetch the filters
-        if enable_filters:
-            search_filters = create_filter(year_range, rating, search_in_title, text)
+        # Show a spinner while the query embedding is generated
+        with st.spinner("Embedding query..."):
+            if is_langchain:
+                query_embedding = embed_query(embedding, EMBEDDING_MODEL, text)
+            else:
+                query_embedding = generate_query_embedding(embedding_client, text)
 
         # Search using the LangChain interface
         if is_langchain:
             # Perform the search using LangChain
-            docs = vector_store.similarity_search_with_score(
-                text, k=no_of_results, search_options=search_filters
+            docs = vector_store.similarity_search_with_score_by_vector(
+                query_embedding, k=no_of_results, search_options=search_filters
             )
 
             for doc in docs:
@@ -287,11 +481,13 @@ if __name__ == "__main__":
             results = search_couchbase(
                 scope,
                 INDEX_NAME,
-                openai_embedding_client,
+                embedding_client,
                 "Overview_embedding",
                 text,
                 k=no_of_results,
                 search_options=search_filters,
+                search_embedding=query_embedding,
+                prefilter=prefilter,
             )
             for doc in results:
                 movie, score = doc
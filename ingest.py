@@ -3,10 +3,13 @@ import os
 from couchbase.cluster import Cluster
 from couchbase.auth import PasswordAuthenticator
 from couchbase.options import ClusterOptions
-from openai import OpenAI
+from openai import AsyncOpenAI, RateLimitError
 from datetime import timedelta
 from tqdm import tqdm
+from itertools import islice
+import asyncio
 import uuid
+import tiktoken
 import pandas as pd
 
 
@@ -19,11 +22,36 @@ DB_BUCKET = os.getenv("DB_BUCKET")
 DB_SCOPE = os.getenv("DB_SCOPE")
 DB_COLLECTION = os.getenv("DB_COLLECTION")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
 MOVIES_DATASET = "imdb_top_1000.csv"
 
-# Use text-embedding-3-small as the embedding model if not set
+# Number of overviews sent to OpenAI in a single embeddings request
+EMBEDDING_BATCH_SIZE = 96
+# Upper bound on the characters sent in a single embeddings request.
+# OpenAI allows up to 2048 inputs and ~300k tokens per request.
+EMBEDDING_BATCH_MAX_CHARS = 500_000
+# Maximum number of tokens of an overview used to generate its embedding
+MAX_TOKENS = 512
+# Maximum number of embeddings requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+# Number of attempts for an embeddings request that is rate limited
+MAX_RETRIES = 5
+# Number of writers upserting the embedded batches into Couchbase
+NUM_WRITERS = 4
+# Maximum number of embedded batches waiting to be written
+QUEUE_SIZE = 4
+# Hosts for which the cluster is considered to be running locally
+LOCAL_HOSTS = ("localhost", "127.0.0.1")
+
+# Cluster shared by all the ingestion runs in this process
+_cluster = None
+
+# Use the default embedding model for the provider if not set
 if not EMBEDDING_MODEL:
-    EMBEDDING_MODEL = "text-embedding-3-small"
+    if EMBEDDING_PROVIDER == "fastembed":
+        EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+    else:
+        EMBEDDING_MODEL = "text-embedding-3-small"
 
 
 def check_environment_variable(variable_name):
@@ -34,22 +62,14 @@ def check_environment_variable(variable_name):
         )
 
 
-# Ensure that all environment variables are set
-check_environment_variable("OPENAI_API_KEY")
-check_environment_variable("DB_CONN_STR")
-check_environment_variable("DB_USERNAME")
-check_environment_variable("DB_PASSWORD")
-check_environment_variable("DB_BUCKET")
-check_environment_variable("DB_SCOPE")
-check_environment_variable("DB_COLLECTION")
-client = OpenAI()
-
-
 def connect_to_couchbase(connection_string, db_username, db_password):
     """Connect to couchbase"""
     print("Connecting to couchbase...")
     auth = PasswordAuthenticator(db_username, db_password)
     options = ClusterOptions(auth)
+    # Use the more lenient timeouts for clusters reached over the network
+    if not is_local_cluster(connection_string):
+        options.apply_profile("wan_development")
     connect_string = connection_string
     cluster = Cluster(connect_string, options)
 
@@ -59,33 +79,196 @@ def connect_to_couchbase(connection_string, db_username, db_password):
     return cluster
 
 
-def generate_embeddings(client, input_data):
-    """Generate OpenAI embeddings for the input data"""
-    response = client.embeddings.create(input=input_data, model=EMBEDDING_MODEL)
-    return response.data[0].embedding
+def is_local_cluster(connection_string):
+    """Check if the connection string only points to hosts on this machine"""
+    hosts = connection_string.split("://")[-1].split("?")[0].split(",")
+    return all(host.split(":")[0] in LOCAL_HOSTS for host in hosts)
+
+
+def get_cluster():
+    """Return the Couchbase cluster, connecting to it on first use"""
+    global _cluster
+    if _cluster is None:
+        _cluster = connect_to_couchbase(DB_CONN_STR, DB_USERNAME, DB_PASSWORD)
+    return _cluster
+
+
+async def generate_embeddings_batch(aclient, texts: list[str]) -> list[list[float]]:
+    """Generate OpenAI embeddings for a batch of texts in a single request"""
+    response = await aclient.embeddings.create(input=texts, model=EMBEDDING_MODEL)
+    return [d.embedding for d in response.data]
+
+
+def generate_local_embeddings_batch(model, texts: list[str]) -> list[list[float]]:
+    """Generate embeddings for a batch of texts locally using fastembed"""
+    # Use the shortest float32 representation of each value to keep the JSON compact
+    return [
+        [float(str(value)) for value in embedding] for embedding in model.embed(texts)
+    ]
+
+
+def batch_rows(
+    rows, batch_size=EMBEDDING_BATCH_SIZE, max_chars=EMBEDDING_BATCH_MAX_CHARS
+):
+    """Split the rows into batches that fit within the embeddings request limits"""
+    rows = iter(rows)
+    while chunk := list(islice(rows, batch_size)):
+        batch, batch_chars = [], 0
+        for row in chunk:
+            row_chars = len(row["Overview"])
+            if batch and batch_chars + row_chars > max_chars:
+                yield batch
+                batch, batch_chars = [], 0
+            batch.append(row)
+            batch_chars += row_chars
+        yield batch
+
+
+def truncate_text(encoding, text, max_tokens=MAX_TOKENS):
+    """Truncate the text to at most max_tokens tokens"""
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+async def embed_batch(embedding_client, batch, overviews):
+    """Add the embeddings to a batch of rows, backing off when rate limited"""
+    for attempt in range(MAX_RETRIES):
+        try:
+            if EMBEDDING_PROVIDER == "fastembed":
+                embeddings = await asyncio.to_thread(
+                    generate_local_embeddings_batch, embedding_client, overviews
+                )
+            else:
+                embeddings = await generate_embeddings_batch(
+                    embedding_client, overviews
+                )
+            break
+        except RateLimitError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(2**attempt)
+
+    for row, embedding in zip(batch, embeddings):
+        row["Overview_embedding"] = embedding
+    return batch
+
 
+def upsert_batch(collection, batch):
+    """Upsert a batch of documents, retrying the failed ones individually"""
+    docs = {uuid.uuid4().hex: row for row in batch}
+    result = collection.upsert_multi(docs)
+    if not result.all_ok:
+        for doc_id in result.exceptions:
+            collection.upsert(doc_id, docs[doc_id])
+
+
+async def embedder(embedding_client, encoding, batches, queue):
+    """Embed the batches concurrently and queue them for the writers"""
+    pending = set()
+    num_truncated = 0
+    # A local model already uses all the cores for a single batch
+    max_in_flight = 1 if EMBEDDING_PROVIDER == "fastembed" else MAX_CONCURRENT_REQUESTS
+
+    async def queue_embedded(return_when):
+        """Wait for the pending batches and queue the embedded ones"""
+        nonlocal pending
+        done, pending = await asyncio.wait(pending, return_when=return_when)
+        for task in done:
+            await queue.put(task.result())
+
+    for batch in batches:
+        # Only the text sent for embedding is truncated, not the stored overview
+        overviews = [truncate_text(encoding, row["Overview"]) for row in batch]
+        num_truncated += sum(
+            overview != row["Overview"] for overview, row in zip(overviews, batch)
+        )
+        pending.add(
+            asyncio.create_task(embed_batch(embedding_client, batch, overviews))
+        )
+
+        # Read the next batch only once there is room for another request
+        if len(pending) >= max_in_flight:
+            await queue_embedded(asyncio.FIRST_COMPLETED)
+
+    if pending:
+        await queue_embedded(asyncio.ALL_COMPLETED)
+    tqdm.write(f"Truncated {num_truncated} overviews to {MAX_TOKENS} tokens")
+
+    # Signal each of the writers that there are no more batches
+    for _ in range(NUM_WRITERS):
+        await queue.put(None)
+
+
+async def writer(collection, queue, progress):
+    """Upsert the embedded batches from the queue into Couchbase"""
+    while (batch := await queue.get()) is not None:
+        await asyncio.to_thread(upsert_batch, collection, batch)
+        progress.update(len(batch))
+
+
+async def main():
+    try:
+        if EMBEDDING_PROVIDER == "fastembed":
+            # Imported here so that the OpenAI provider doesn't load fastembed
+            from fastembed import TextEmbedding
+
+            embedding_client = TextEmbedding(model_name=EMBEDDING_MODEL)
+            # Approximates the token count as fastembed models have their own tokenizer
+            encoding = tiktoken.get_encoding("cl100k_base")
+        else:
+            embedding_client = AsyncOpenAI()
+            try:
+                encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+            except KeyError:
+                # Models unknown to tiktoken, such as Azure deployment names
+                encoding = tiktoken.get_encoding("cl100k_base")
+        cluster = get_cluster()
+        bucket = cluster.bucket(DB_BUCKET)
+        scope = bucket.scope(DB_SCOPE)
+        collection = scope.collection(DB_COLLECTION)
+        data = pd.read_csv(MOVIES_DATASET, engine="pyarrow", dtype_backend="pyarrow")
+
+        # Convert columns to numeric types and fill empty values in a single pass
+        data = data.assign(
+            Gross=pd.to_numeric(
+                data["Gross"].str.replace(",", "", regex=False), errors="coerce"
+            ).fillna(0),
+            Certificate=data["Certificate"].fillna("NA"),
+            Meta_score=data["Meta_score"].fillna(-1),
+        )
+
+        # Build the documents lazily so only the batches in flight are in memory
+        columns = data.columns.tolist()
+        rows = (
+            dict(zip(columns, values))
+            for values in data.itertuples(index=False, name=None)
+        )
 
-try:
-    cluster = connect_to_couchbase(DB_CONN_STR, DB_USERNAME, DB_PASSWORD)
-    bucket = cluster.bucket(DB_BUCKET)
-    scope = bucket.scope(DB_SCOPE)
-    collection = scope.collection(DB_COLLECTION)
-    data = pd.read_csv(MOVIES_DATASET)
+        # Upsert the batches into Couchbase while the next ones are being embedded
+        print("Ingesting Data...")
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        batches = batch_rows(rows)
+        with tqdm(total=len(data)) as progress:
+            await asyncio.gather(
+                embedder(embedding_client, encoding, batches, queue),
+                *(writer(collection, queue, progress) for _ in range(NUM_WRITERS)),
+            )
 
-    # Convert columns to numeric types
-    data["Gross"] = data["Gross"].str.replace(",", "").astype(float)
+    except Exception as e:
+        print("Error while ingesting data", e)
 
-    # Fill empty values
-    data["Gross"] = data["Gross"].fillna(0)
-    data["Certificate"] = data["Certificate"].fillna("NA")
-    data["Meta_score"] = data["Meta_score"].fillna(-1)
 
-    data_in_dict = data.to_dict(orient="records")
-    print("Ingesting Data...")
-    for row in tqdm(data_in_dict):
-        row["Overview_embedding"] = generate_embeddings(client, row["Overview"])
-        doc_id = uuid.uuid4().hex
-        collection.upsert(doc_id, row)
+if __name__ == "__main__":
+    # Ensure that all environment variables are set
+    if EMBEDDING_PROVIDER != "fastembed":
+        check_environment_variable("OPENAI_API_KEY")
+    check_environment_variable("DB_CONN_STR")
+    check_environment_variable("DB_USERNAME")
+    check_environment_variable("DB_PASSWORD")
+    check_environment_variable("DB_BUCKET")
+    check_environment_variable("DB_SCOPE")
+    check_environment_variable("DB_COLLECTION")
 
-except Exception as e:
-    print("Error while ingesting data", e)
+    asyncio.run(main())